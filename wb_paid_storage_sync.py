@@ -1,40 +1,126 @@
 import os
 import sys
 import time
+import random
 import json
 import hashlib
+import importlib.util
+import functools
+import itertools
+import operator
+import threading
 import datetime as dt
-from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Collection, Dict, Iterable, Iterator, List, Optional
 
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry, make_headers
 from supabase import create_client
 
+try:
+    import orjson  # быстрый JSON (Rust); опционален
+except ImportError:
+    orjson = None
+
+try:
+    import psycopg  # прямое подключение к Postgres для COPY; опционален
+except ImportError:
+    psycopg = None
+
+try:
+    import ijson  # потоковый разбор большого ответа download; опционален
+except ImportError:
+    ijson = None
+
 # ================== Конфиг ==================
 WB_BASE   = os.getenv("WB_API_BASE", "https://seller-analytics-api.wildberries.ru")
-WB_TOKEN  = os.environ["WB_API_TOKEN"]
+# WB_API_TOKENS — несколько токенов одного продавца через запятую: лимиты WB считаются на токен
+WB_TOKENS = tuple(t.strip() for t in (os.getenv("WB_API_TOKENS") or os.environ["WB_API_TOKEN"]).split(",") if t.strip())
 SB_URL    = os.environ["SUPABASE_URL"]
 SB_KEY    = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
+# если задан — пишем напрямую в Postgres через COPY, минуя PostgREST
+SB_DB_URL = os.getenv("SUPABASE_DB_URL")
 
 # до 8 дней за одно окно
 MAX_DAYS = 8
 
 # лимиты/паузы
-POLL_EVERY_SECONDS = 10            # опрос статуса
+POLL_FIRST_SECONDS = 2            # опрос статуса: первый интервал, дальше ×1.5
+POLL_MAX_SECONDS = 30              # потолок интервала опроса
+POLL_MAX_SECONDS_LATE = 60         # потолок, когда task строится дольше 2 минут
 PRINT_HEARTBEAT_EVERY = 60         # раз в минуту писать «живой» статус
 OVERALL_WAIT_SECONDS = 240         # сколько максимум ждём готовности task за один запуск
 DOWNLOAD_TIMEOUT = 120             # таймаут HTTP при download
-AFTER_DOWNLOAD_COOLDOWN = 65       # пауза, чтобы не ловить 429 на следующем окне
+AFTER_DOWNLOAD_COOLDOWN = 65       # минимальный интервал между download (лимит WB ~1/мин)
+CREATE_TASK_INTERVAL = 60          # минимальный интервал между созданием task (лимит WB ~1/мин)
+WB_CONCURRENCY = int(os.getenv("WB_CONCURRENCY", "4"))  # сколько task WB строятся параллельно
 
 # таблица в Supabase (PK: date,nm_id,chrt_id,office_id)
 TABLE_NAME = "wb_paid_storage_x"
+PK_COLUMNS = ("date", "nm_id", "chrt_id", "office_id")
+
+# строк в одном upsert-запросе и порог, при котором копящийся буфер сбрасывается в Supabase
+UPSERT_CHUNK = 1000
+FLUSH_EVERY_ROWS = UPSERT_CHUNK * 10
+UPSERT_WORKERS = 4                 # сколько upsert-запросов в PostgREST летит параллельно
+READ_PAGE_ROWS = 1000              # страница чтения из PostgREST = его max-rows (по умолчанию в Supabase 1000)
+COPY_MIN_ROWS = 5000               # с SUPABASE_DB_URL: от стольких строк пишем через COPY, меньше — через REST
 
+# Authorization — у каждого токена свой (WbToken.auth), передаётся в запросе
 HEADERS = {
-    "Authorization": f"Bearer {WB_TOKEN}",
-    "Accept": "application/json"
+    "Accept": "application/json",
+    # отчёт download — самый тяжёлый ответ; gzip (и br, если установлен brotli) режет его в разы
+    "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"],
 }
 
+# 429/5xx повторяет сам транспорт (с учётом Retry-After); после исчерпания отдаёт последний ответ
+WB_RETRY = Retry(
+    total=5,
+    backoff_factor=0.5,
+    backoff_max=60,
+    backoff_jitter=0.5,            # несколько потоков на одном 429 не повторяют синхронно
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"GET"}),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+# create и download WB пускает ~1/мин: 429 там транспорт не повторяет (повтор в обход bucket
+# съел бы лимит), его ждут сами wb_create_task/wb_download. Транспорт повторяет только 5xx.
+# respect_retry_after_header=False обязательно: иначе urllib3 повторяет 429 с Retry-After
+# даже вне status_forcelist
+WB_RETRY_LIMITED = WB_RETRY.new(status_forcelist=(500, 502, 503, 504), respect_retry_after_header=False)
+
+# HTTP-сессии на весь запуск: keep-alive, TCP/TLS к WB переиспользуется между запросами.
+# SESSION — опрос статуса, SESSION_LIMITED — create/download
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=WB_RETRY))
+SESSION_LIMITED = requests.Session()
+SESSION_LIMITED.headers.update(HEADERS)
+SESSION_LIMITED.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=WB_RETRY_LIMITED))
+
+# запись в PostgREST без supabase-py: тело кодируем сами (orjson), ответ с данными не просим.
+# HTTP/2 (если установлен h2): параллельные upsert-чанки мультиплексируются в одном TLS-соединении
+SB_REST = f"{SB_URL.rstrip('/')}/rest/v1"
+SB_HTTP = httpx.Client(
+    base_url=SB_REST,
+    http2=importlib.util.find_spec("h2") is not None,
+    headers={
+        "apikey": SB_KEY,
+        "Authorization": f"Bearer {SB_KEY}",
+        "Content-Type": "application/json",
+        "Prefer": "resolution=merge-duplicates,return=minimal",
+    },
+    limits=httpx.Limits(max_connections=UPSERT_WORKERS),
+    timeout=120,
+)
+
 # ================== Помощники ==================
+@functools.lru_cache(maxsize=1)
 def supa():
+    # один клиент (и его httpx-пул) на весь запуск
     return create_client(SB_URL, SB_KEY)
 
 def clamp_days_back(n: int) -> int:
@@ -47,26 +133,95 @@ def dates_window(days_back: int) -> tuple[dt.date, dt.date]:
     start = today - dt.timedelta(days=days_back - 1)
     return start, today
 
+def chunks_8days(date_from: dt.date, date_to: dt.date) -> List[tuple[dt.date, dt.date]]:
+    # WB отдаёт не больше MAX_DAYS за одно окно — режем период на последовательные окна
+    out = []
+    a = date_from
+    while a <= date_to:
+        b = min(a + dt.timedelta(days=MAX_DAYS - 1), date_to)
+        out.append((a, b))
+        a = b + dt.timedelta(days=1)
+    return out
+
+def _batched(items: Iterable[Any], n: int) -> Iterator[List[Any]]:
+    # как itertools.batched (3.12+): порции по n без срезов-копий исходного списка
+    it = iter(items)
+    while chunk := list(itertools.islice(it, n)):
+        yield chunk
+
+def _loads(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def _snippet(obj: Any, n: int = 500) -> str:
+    # для сообщений об ошибках: тем же сериализатором, что и всё остальное
+    return _dumps(obj)[:n].decode("utf-8", "replace")
+
 def _safe_json(r: requests.Response) -> Any:
     try:
-        return r.json()
+        return _loads(r.content)
     except Exception:
         text = (r.text or "")[:500]
         raise RuntimeError(f"WB returned non-JSON (status {r.status_code}): {text}")
 
+def next_backoff(prev: float, base: float = 2, cap: float = 120) -> float:
+    # decorrelated jitter: параллельные раннеры не просыпаются синхронно на один и тот же 429
+    return min(cap, base + (prev * 3 - base) * random.random())
+
 # ================== WB API ==================
-def wb_create_task(date_from: dt.date, date_to: dt.date) -> str:
+class TokenBucket:
+    """
+    Не чаще одного acquire() в 1/per_sec секунд.
+    Ждёт только если предыдущий acquire был недавно — работа между ними (upsert и т.п.) идёт в зачёт паузы.
+    """
+    def __init__(self, per_sec: float):
+        self.interval = 1 / per_sec
+        self.next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # слот резервируем под локом, спим без него — потоки встают в очередь по слотам
+        with self._lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+class WbToken:
+    """
+    Токен WB со своими лимитами на create и download.
+    task скачивается тем же токеном, которым создан.
+    """
+    def __init__(self, token: str):
+        self.auth = {"Authorization": f"Bearer {token}"}
+        self.create_bucket = TokenBucket(per_sec=1 / CREATE_TASK_INTERVAL)
+        self.download_bucket = TokenBucket(per_sec=1 / AFTER_DOWNLOAD_COOLDOWN)
+
+_wb_tokens = [WbToken(t) for t in WB_TOKENS]
+
+def wb_create_task(date_from: dt.date, date_to: dt.date, tok: WbToken) -> str:
     """
     Создаёт task через GET /api/v1/paid_storage?dateFrom&dateTo
-    Возвращает taskId.
+    Возвращает taskId. Не чаще раза в CREATE_TASK_INTERVAL на токен; на 429 ждём 60..120 секунд с джиттером.
     """
-    url = f"{WB_BASE}/api/v1/paid_storage"
-    r = requests.get(
-        url,
-        params={"dateFrom": date_from.isoformat(), "dateTo": date_to.isoformat()},
-        headers=HEADERS,
-        timeout=60,
-    )
+    # query собираем один раз: все повторы шлют уже готовый URL
+    url = f"{WB_BASE}/api/v1/paid_storage?dateFrom={date_from.isoformat()}&dateTo={date_to.isoformat()}"
+    delay = CREATE_TASK_INTERVAL
+    for attempt in range(6):
+        tok.create_bucket.acquire()
+        r = SESSION_LIMITED.get(url, headers=tok.auth, timeout=60)
+        if r.status_code != 429:
+            break
+        print(f"WB 429 on create task, sleep {delay:.0f}s (attempt {attempt+1}/6)")
+        time.sleep(delay)
+        delay = next_backoff(delay, base=CREATE_TASK_INTERVAL, cap=120)
     r.raise_for_status()
     payload = _safe_json(r)
     # ожидаем {"data":{"taskId":"..."}} от WB
@@ -76,42 +231,36 @@ def wb_create_task(date_from: dt.date, date_to: dt.date) -> str:
             raise KeyError
         return task_id
     except Exception:
-        snippet = json.dumps(payload, ensure_ascii=False)[:500]
+        snippet = _snippet(payload)
         raise RuntimeError(f"Unexpected WB response (create task): {snippet}")
 
-def wb_task_status(task_id: str) -> str:
+def wb_task_status(task_id: str, tok: WbToken) -> str:
     """
     GET /api/v1/paid_storage/tasks/{taskId}/status -> {"data":{"status":"new|processing|done|error"}}
-    С экспоненциальным бэкоффом на 429/5xx — но не более пары секунд на вызов.
+    429/5xx повторяет адаптер SESSION (WB_RETRY).
     """
     url = f"{WB_BASE}/api/v1/paid_storage/tasks/{task_id}/status"
-    delay = 1
-    for _ in range(6):
-        r = requests.get(url, headers=HEADERS, timeout=30)
-        if r.status_code in (429,) or (500 <= r.status_code < 600):
-            time.sleep(delay)
-            delay = min(delay * 2, 6)
-            continue
-        r.raise_for_status()
-        payload = _safe_json(r)
-        try:
-            return payload["data"]["status"]
-        except Exception:
-            snippet = json.dumps(payload, ensure_ascii=False)[:500]
-            raise RuntimeError(f"Unexpected WB response (status): {snippet}")
-    # если так и не вышли из 429/5xx
+    r = SESSION.get(url, headers=tok.auth, timeout=30)
     r.raise_for_status()
-    return "new"  # теоретически недостижимо
+    payload = _safe_json(r)
+    try:
+        return payload["data"]["status"]
+    except Exception:
+        snippet = _snippet(payload)
+        raise RuntimeError(f"Unexpected WB response (status): {snippet}")
 
-def wb_wait_done(task_id: str, overall_seconds: int = OVERALL_WAIT_SECONDS) -> Optional[str]:
+def wb_wait_done(task_id: str, tok: WbToken, overall_seconds: int = OVERALL_WAIT_SECONDS) -> Optional[str]:
     """
     Ожидает статусы 'done'/'error' до overall_seconds.
+    Интервал опроса растёт от POLL_FIRST_SECONDS до POLL_MAX_SECONDS(_LATE).
     Возвращает финальный статус или None, если не дождались.
     """
     start = time.time()
     last_print = 0.0
+    step = POLL_FIRST_SECONDS
+    prev = None
     while True:
-        s = wb_task_status(task_id)
+        s = wb_task_status(task_id, tok)
         now = time.time()
 
         if s == "done":
@@ -126,33 +275,118 @@ def wb_wait_done(task_id: str, overall_seconds: int = OVERALL_WAIT_SECONDS) -> O
             print(f"waiting WB task {task_id}, status={s}, elapsed={int(now - start)}s")
             last_print = now
 
-        time.sleep(POLL_EVERY_SECONDS)
+        # адаптивный опрос: маленькие отчёты ловим быстро, длинные не долбим каждые 10с
+        if prev == "new" and s == "processing":
+            step = 5
+        ceiling = POLL_MAX_SECONDS_LATE if (now - start) > 120 else POLL_MAX_SECONDS
+        # ±10%: параллельные prepare_window не опрашивают WB в одну и ту же секунду
+        time.sleep(min(step, ceiling) * random.uniform(0.9, 1.1))
+        step = min(step * 1.5, ceiling)
+        prev = s
+
+# ключи, под которыми WB иногда кладёт массив строк вместо голого массива
+DOWNLOAD_LIST_KEYS = ("data", "result", "items", "rows")
+
+class _HeadTap:
+    """Поток-обёртка для ijson: запоминает первые n байт ответа — для диагностики."""
+    def __init__(self, raw: Any, n: int = 500):
+        self._raw = raw
+        self._n = n
+        self.head = b""
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._raw.read(size)
+        if len(self.head) < self._n:
+            self.head += chunk[:self._n - len(self.head)]
+        return chunk
+
+def _array_events(events: Iterator[tuple], key: str) -> Iterator[tuple]:
+    # события массива под ключом key с префиксом "<key>.item..." -> "item...", до его end_array
+    yield "", "start_array", None
+    cut = len(key) + 1
+    for prefix, event, value in events:
+        if prefix == key and event == "end_array":
+            yield "", "end_array", None
+            return
+        yield prefix[cut:], event, value
+
+def _iter_download_stream(r: requests.Response) -> Iterator[Dict[str, Any]]:
+    """
+    Разбирает ответ download потоково (ijson): строки отдаются по одной,
+    весь отчёт целиком как Python-список в памяти не собирается.
+    Ключи-обёртки выбираются по приоритету DOWNLOAD_LIST_KEYS, как в разборе без ijson:
+    потоково идёт только первый из них, остальные копятся, пока не ясно, что лучшего нет.
+    """
+    r.raw.decode_content = True
+    src = _HeadTap(r.raw)
+    events = ijson.parse(src, use_float=True)
+    try:
+        first = next(events)
+    except StopIteration:
+        return
+    except ijson.JSONError:
+        raise RuntimeError(f"WB returned non-JSON (status {r.status_code})")
+    if first[1] == "start_array":
+        yield from ijson.items(itertools.chain([first], events), "item")
+        return
+    if first[1] != "start_map":
+        # совсем неожиданно
+        return
+
+    # {"data":[...]} и т.п.: ключ верхнего уровня со списком
+    best_rank, best_rows = len(DOWNLOAD_LIST_KEYS), None
+    for prefix, event, _ in events:
+        if event != "start_array" or prefix not in DOWNLOAD_LIST_KEYS:
+            continue
+        rank = DOWNLOAD_LIST_KEYS.index(prefix)
+        rows = ijson.items(_array_events(events, prefix), "item")
+        if rank == 0:
+            yield from rows
+            for _ in events:  # дочитываем ответ — соединение вернётся в пул
+                pass
+            return
+        if rank < best_rank:
+            best_rank, best_rows = rank, list(rows)
+        else:
+            for _ in _array_events(events, prefix):
+                pass
+    if best_rows is not None:
+        yield from best_rows
+        return
+    # если это был только ответ с taskId (вдруг скачали слишком рано)
+    print("WB returned dict payload, but no list found in typical keys. First 500 chars:")
+    print(src.head.decode("utf-8", "replace"))
 
-def wb_download(task_id: str) -> List[Dict[str, Any]]:
+def wb_download(task_id: str, tok: WbToken) -> Iterable[Dict[str, Any]]:
     """
     GET /api/v1/paid_storage/tasks/{taskId}/download
-    Ловим 429 — ждём 65/80/… секунд.
+    Не чаще раза в AFTER_DOWNLOAD_COOLDOWN; на 429 ждём 65..120 секунд с джиттером.
+    С ijson строки отдаются потоково, по мере чтения ответа.
     """
     url = f"{WB_BASE}/api/v1/paid_storage/tasks/{task_id}/download"
     delay = 65
     for attempt in range(6):
-        r = requests.get(url, headers=HEADERS, timeout=DOWNLOAD_TIMEOUT)
+        tok.download_bucket.acquire()
+        r = SESSION_LIMITED.get(url, headers=tok.auth, timeout=DOWNLOAD_TIMEOUT, stream=True)
         if r.status_code == 429:
-            print(f"WB 429 on download, sleep {delay}s (attempt {attempt+1}/6)")
+            r.close()
+            print(f"WB 429 on download, sleep {delay:.0f}s (attempt {attempt+1}/6)")
             time.sleep(delay)
-            delay = min(delay + 15, 120)
+            delay = next_backoff(delay, base=65, cap=120)
             continue
         r.raise_for_status()
+        if ijson is not None:
+            return _iter_download_stream(r)
         data = _safe_json(r)
         # Некоторые окружения WB возвращают сразу массив, иногда {"data":[...]}
         if isinstance(data, list):
             return data
         if isinstance(data, dict):
-            for key in ("data", "result", "items", "rows"):
+            for key in DOWNLOAD_LIST_KEYS:
                 if key in data and isinstance(data[key], list):
                     return data[key]
             # если это был только ответ с taskId (вдруг скачали слишком рано)
-            snippet = json.dumps(data, ensure_ascii=False)[:500]
+            snippet = _snippet(data)
             print("WB returned dict payload, but no list found in typical keys. First 500 chars:")
             print(snippet)
             return []
@@ -162,104 +396,301 @@ def wb_download(task_id: str) -> List[Dict[str, Any]]:
     return []
 
 # ================== Трансформация + Supabase ==================
+# в окне всего несколько разных дат: кэш отдаёт один и тот же объект-строку на все строки окна
+@functools.lru_cache(maxsize=128)
 def _d10(s: Optional[str]) -> Optional[str]:
-    return None if not s else s[:10]
+    # обычный случай — строка от WB; срез уже 10-символьной строки возвращает её же, без копии
+    if not s:
+        return None
+    return s[:10] if isinstance(s, str) else str(s)[:10]
+
+def _intern(s: Any) -> Any:
+    # склады/бренды/предметы повторяются на тысячах строк: один объект-строка на значение вместо копии в каждой
+    return sys.intern(s) if type(s) is str else s
+
+# (колонка в Supabase, ключ в ответе WB, преобразование значения или None)
+_MAP = (
+    ("date",               "date",             _d10),
+    ("log_warehouse_coef", "logWarehouseCoef", None),
+    ("office_id",          "officeId",         None),
+    ("warehouse",          "warehouse",        _intern),
+    ("warehouse_coef",     "warehouseCoef",    None),
+    ("gi_id",              "giId",             None),
+    ("chrt_id",            "chrtId",           None),
+    ("size",               "size",             _intern),
+    ("barcode",            "barcode",          None),
+    ("subject",            "subject",          _intern),
+    ("brand",              "brand",            _intern),
+    ("vendor_code",        "vendorCode",       _intern),
+    ("nm_id",              "nmId",             None),
+    ("volume",             "volume",           None),
+    ("calc_type",          "calcType",         None),
+    ("warehouse_price",    "warehousePrice",   None),
+    ("barcodes_count",     "barcodesCount",    None),
+    ("pallet_place_code",  "palletPlaceCode",  None),
+    ("pallet_count",       "palletCount",      None),
+    ("original_date",      "originalDate",     _d10),
+    ("loyalty_discount",   "loyaltyDiscount",  None),
+    ("tariff_fix_date",    "tariffFixDate",    _d10),
+    ("tariff_lower_date",  "tariffLowerDate",  _d10),
+)
+
+# поля отпечатка _hash в фиксированном порядке (_source_task_id не входит — он меняется каждый запуск)
+_HASH_FIELDS = tuple(dst for dst, _, _ in _MAP)
+
+# отпечаток только для сравнения «изменилась ли строка» — крипто-стойкость не нужна.
+# Состояние с префиксом-версией строим один раз и копируем на каждую строку;
+# сменилась схема отпечатка — поднимаем версию, и все _hash пересчитаются.
+_HASH_BASE = hashlib.blake2b(b"wbps2\x00", digest_size=16)
+_hash_values = operator.itemgetter(*_HASH_FIELDS)
+
+def _compile_extractor(field_map) -> Any:
+    """
+    Собирает из field_map плоскую функцию row -> dict — тот же словарь-литерал,
+    что писался бы руками, но без цикла по таблице и проверки conv на каждое поле.
+    """
+    lines = ["def _extract(row):", "    g = row.get", "    return {"]
+    ns = {}
+    for dst, src, conv in field_map:
+        val = f"g({src!r})"
+        if conv is not None:
+            ns[conv.__name__] = conv
+            val = f"{conv.__name__}({val})"
+        lines.append(f"        {dst!r}: {val},")
+    lines.append("    }")
+    exec("\n".join(lines), ns)
+    return ns["_extract"]
+
+_extract_row = _compile_extractor(_MAP)
 
 def normalize_row(row: Dict[str, Any], task_id: str) -> Dict[str, Any]:
-    out = {
-        "date":               _d10(row.get("date")),
-        "log_warehouse_coef": row.get("logWarehouseCoef"),
-        "office_id":          row.get("officeId"),
-        "warehouse":          row.get("warehouse"),
-        "warehouse_coef":     row.get("warehouseCoef"),
-        "gi_id":              row.get("giId"),
-        "chrt_id":            row.get("chrtId"),
-        "size":               row.get("size"),
-        "barcode":            row.get("barcode"),
-        "subject":            row.get("subject"),
-        "brand":              row.get("brand"),
-        "vendor_code":        row.get("vendorCode"),
-        "nm_id":              row.get("nmId"),
-        "volume":             row.get("volume"),
-        "calc_type":          row.get("calcType"),
-        "warehouse_price":    row.get("warehousePrice"),
-        "barcodes_count":     row.get("barcodesCount"),
-        "pallet_place_code":  row.get("palletPlaceCode"),
-        "pallet_count":       row.get("palletCount"),
-        "original_date":      _d10(row.get("originalDate")),
-        "loyalty_discount":   row.get("loyaltyDiscount"),
-        "tariff_fix_date":    _d10(row.get("tariffFixDate")),
-        "tariff_lower_date":  _d10(row.get("tariffLowerDate")),
-        "_source_task_id":    task_id,
-    }
-    out["_hash"] = hashlib.sha256(
-        json.dumps(out, ensure_ascii=False, sort_keys=True).encode("utf-8")
-    ).hexdigest()
+    out = _extract_row(row)
+    out["_source_task_id"] = task_id
+    # repr кортежа значений однозначен (строки в кавычках, None отдельно) и собирается в C за один вызов
+    h = _HASH_BASE.copy()
+    h.update(repr(_hash_values(out)).encode("utf-8"))
+    out["_hash"] = h.hexdigest()
     return out
 
-def upsert_rows(rows: List[Dict[str, Any]]):
+# все колонки, которые пишем в TABLE_NAME
+_DB_COLUMNS = _HASH_FIELDS + ("_source_task_id", "_hash")
+
+def _upsert_rows_copy(rows: Collection[Dict[str, Any]]):
+    """
+    COPY во временную таблицу + INSERT ... ON CONFLICT одним запросом.
+    Без PostgREST и JSON на пути записи. rows уже без дублей по PK.
+    """
+    cols = ", ".join(_DB_COLUMNS)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in _DB_COLUMNS if c not in PK_COLUMNS)
+    with psycopg.connect(SB_DB_URL) as conn, conn.cursor() as cur:
+        cur.execute(f"CREATE TEMP TABLE _stage (LIKE {TABLE_NAME} INCLUDING DEFAULTS) ON COMMIT DROP")
+        with cur.copy(f"COPY _stage ({cols}) FROM STDIN") as cp:
+            for r in rows:
+                cp.write_row(tuple(r[c] for c in _DB_COLUMNS))
+        cur.execute(
+            f"INSERT INTO {TABLE_NAME} ({cols}) SELECT {cols} FROM _stage "
+            f"ON CONFLICT ({', '.join(PK_COLUMNS)}) DO UPDATE SET {updates}"
+        )
+
+def _existing_hashes(date_from: str, date_to: str) -> Dict[tuple, str]:
+    """
+    PK -> _hash строк, уже лежащих в TABLE_NAME за даты date_from..date_to.
+    Через PostgREST читаем страницами по READ_PAGE_ROWS. Конец — только пустая страница:
+    если max-rows на сервере меньше READ_PAGE_ROWS, короткая страница ещё не значит «всё».
+    """
+    if SB_DB_URL and psycopg is not None:
+        with psycopg.connect(SB_DB_URL) as conn:
+            cur = conn.execute(
+                f"SELECT date::text, nm_id, chrt_id, office_id, _hash FROM {TABLE_NAME} "
+                f"WHERE date BETWEEN %s AND %s",
+                (date_from, date_to),
+            )
+            return {tuple(rec[:4]): rec[4] for rec in cur}
+
+    client = supa()
+    existing: Dict[tuple, str] = {}
+    offset = 0
+    while True:
+        page = (
+            client.table(TABLE_NAME)
+            .select(",".join(PK_COLUMNS) + ",_hash")
+            .gte("date", date_from)
+            .lte("date", date_to)
+            .order(",".join(PK_COLUMNS))
+            .range(offset, offset + READ_PAGE_ROWS - 1)
+            .execute()
+            .data
+        )
+        if not page:
+            return existing
+        for r in page:
+            existing[(r["date"], r["nm_id"], r["chrt_id"], r["office_id"])] = r["_hash"]
+        offset += len(page)
+
+def _post_chunk(chunk: List[Dict[str, Any]]):
+    r = SB_HTTP.post(
+        f"/{TABLE_NAME}",
+        params={"on_conflict": ",".join(PK_COLUMNS)},
+        content=_dumps(chunk),
+    )
+    r.raise_for_status()
+
+def upsert_rows(rows: Collection[Dict[str, Any]]):
+    """rows должны быть уже без дублей по PK — их так собирает UpsertBuffer."""
     if not rows:
         return
-    # дедуп внутри батча по PK (date, nm_id, chrt_id, office_id)
-    seen = {}
-    for r in rows:
-        key = (r.get("date"), r.get("nm_id"), r.get("chrt_id"), r.get("office_id"))
-        seen[key] = r
-    rows = list(seen.values())
+    if SB_DB_URL and psycopg is not None and len(rows) >= COPY_MIN_ROWS:
+        _upsert_rows_copy(rows)
+        return
 
-    client = supa()
-    for i in range(0, len(rows), 1000):
-        chunk = rows[i:i+1000]
-        client.table(TABLE_NAME).upsert(
-            chunk, on_conflict="date,nm_id,chrt_id,office_id"
-        ).execute()
+    # строки уже без дублей по PK — параллельные чанки не конфликтуют между собой
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as ex:
+        list(ex.map(_post_chunk, _batched(rows, UPSERT_CHUNK)))
+
+class UpsertBuffer:
+    """
+    Общий буфер строк на все окна запуска: в Supabase уходит порциями по flush_every,
+    а не отдельным upsert на каждое окно. Остаток — явным flush() в конце.
+    Дедуп по PK (date, nm_id, chrt_id, office_id) прямо при добавлении: последняя строка побеждает.
+    """
+    def __init__(self, flush_every: int = FLUSH_EVERY_ROWS):
+        self.flush_every = flush_every
+        self._rows: Dict[tuple, Dict[str, Any]] = {}
+
+    def append(self, row: Dict[str, Any]):
+        # после normalize_row эти ключи есть всегда — берём по индексу, без .get
+        self._rows[(row["date"], row["nm_id"], row["chrt_id"], row["office_id"])] = row
+        if len(self._rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        upsert_rows(self._rows.values())
+        self._rows = {}
 
 # ================== Основной сценарий ==================
-def process_window(date_from: dt.date, date_to: dt.date) -> str:
+def prepare_window(date_from: dt.date, date_to: dt.date, tok: WbToken) -> tuple[str, str]:
+    """
+    Создаёт task на окно и ждёт, пока WB его построит.
+    Возвращает (task_id, "ok" | "timeout" | "error"). Безопасно вызывать из нескольких потоков.
+    """
     print(f"[SYNC] {date_from}..{date_to}")
-    task_id = wb_create_task(date_from, date_to)
+    task_id = wb_create_task(date_from, date_to, tok)
     # небольшой лаг перед первым статусом
     time.sleep(2)
 
-    final_status = wb_wait_done(task_id)
+    final_status = wb_wait_done(task_id, tok)
     if final_status is None:
         print(f"Task {task_id} not ready (timeout). Will retry on next run.")
-        return "timeout"
+        return task_id, "timeout"
     if final_status != "done":
         print(f"Task {task_id} ended with status={final_status}. Skipping.")
-        return "error"
-
-    data = wb_download(task_id)
-    print(f"rows downloaded: {len(data)} for {date_from}..{date_to}")
+        return task_id, "error"
+    return task_id, "ok"
 
-    rows = [normalize_row(r, task_id) for r in data]
-    upsert_rows(rows)
+def load_window(date_from: dt.date, date_to: dt.date, task_id: str, tok: WbToken, buffer: UpsertBuffer):
+    """
+    Скачивает готовый task и складывает в buffer только изменившиеся строки (по _hash).
+    Неизменённые строки не перезаписываются, поэтому _source_task_id в таблице —
+    task, в котором строка последний раз изменилась, а не последний запуск.
+    Буфер сбрасывается в Supabase прямо во время чтения ответа, как только
+    набирается FLUSH_EVERY_ROWS, и в конце запуска — память не растёт с размером окна.
+    """
+    existing = _existing_hashes(date_from.isoformat(), date_to.isoformat())
+    downloaded = changed = 0
+    # PK, уже отданные в buffer в этом окне: повтор такого PK в отчёте пишем всегда, даже если
+    # он совпал с existing — иначе победила бы ранняя строка (она могла уже уйти в flush)
+    queued = set()
+    for raw in wb_download(task_id, tok):
+        downloaded += 1
+        r = normalize_row(raw, task_id)
+        key = (r["date"], r["nm_id"], r["chrt_id"], r["office_id"])
+        if key not in queued and existing.get(key) == r["_hash"]:
+            continue
+        queued.add(key)
+        changed += 1
+        buffer.append(r)
+    print(f"rows downloaded: {downloaded}, changed: {changed} for {date_from}..{date_to}")
 
-    # пауза после успешного download — на случай следующего окна в будущем
-    time.sleep(AFTER_DOWNLOAD_COOLDOWN)
-    return "ok"
+def run_windows(windows: List[tuple[dt.date, dt.date]]) -> int:
+    """
+    Task'и на окна строятся параллельно (до WB_CONCURRENCY, создание — не чаще CREATE_TASK_INTERVAL на токен),
+    а скачивание идёт в этом потоке по порядку окон: пока качаем окно N, WB уже строит следующие.
+    Один буфер строк на все окна — в Supabase уходит крупными порциями.
+    """
+    # окна по кругу раскладываем по токенам: соседние download не ждут кулдаун друг друга
+    toks = [_wb_tokens[i % len(_wb_tokens)] for i in range(len(windows))]
+    buffer = UpsertBuffer()
+    with ThreadPoolExecutor(max_workers=WB_CONCURRENCY) as ex:
+        futures = [ex.submit(prepare_window, a, b, tok) for (a, b), tok in zip(windows, toks)]
+        for (d_from, d_to), tok, fut in zip(windows, toks, futures):
+            try:
+                task_id, status = fut.result()
+                if status == "ok":
+                    load_window(d_from, d_to, task_id, tok, buffer)
+            except Exception as e:
+                # одно упавшее окно не роняет остальные — дожмём следующим запуском
+                status = f"failed: {e}"
+            if status != "ok":
+                print(f"window {d_from}..{d_to}: {status}")
+    buffer.flush()
+    # НИКОГДА не фейлим job — пусть следующий запуск дожмёт.
+    return 0
 
 def cmd_sync(days_back: int = 8) -> int:
     n = clamp_days_back(days_back)
-    d_from, d_to = dates_window(n)
-    status = process_window(d_from, d_to)
-    # НИКОГДА не фейлим job — пусть следующий запуск дожмёт.
-    return 0
+    return run_windows([dates_window(n)])
+
+def cmd_range(date_from: dt.date, date_to: dt.date) -> int:
+    return run_windows(chunks_8days(date_from, date_to))
+
+def cmd_backfill(days_back: int = 365) -> int:
+    today = dt.date.today()
+    return cmd_range(today - dt.timedelta(days=days_back - 1), today)
 
 # ================== CLI ==================
+USAGE = "Usage: sync [days_back<=8] | range YYYY-MM-DD YYYY-MM-DD | since YYYY-MM-DD | backfill [days_back]"
+
+def _int_arg(argv: List[str], i: int, default: int) -> int:
+    if len(argv) > i:
+        try:
+            return int(argv[i])
+        except ValueError:
+            pass
+    return default
+
 def main(argv: List[str]) -> int:
+    if not WB_TOKENS:
+        # переменная задана, но после split по запятым токенов не осталось (пустой secret, ",")
+        raise KeyError("WB_API_TOKENS" if os.getenv("WB_API_TOKENS") else "WB_API_TOKEN")
     if len(argv) < 2:
-        print("Usage: sync [days_back<=8]")
+        print(USAGE)
         return 1
-    if argv[1] == "sync":
-        days = 8
-        if len(argv) > 2:
-            try:
-                days = int(argv[2])
-            except ValueError:
-                pass
-        return cmd_sync(days)
+    cmd = argv[1]
+    if cmd == "sync":
+        return cmd_sync(_int_arg(argv, 2, 8))
+    if cmd == "backfill":
+        days_back = _int_arg(argv, 2, 365)
+        if days_back < 1:
+            print(USAGE)
+            return 1
+        return cmd_backfill(days_back)
+    if cmd in ("range", "since"):
+        # пустой список окон — это опечатка в аргументах, а не успешный запуск
+        if len(argv) < (4 if cmd == "range" else 3):
+            print(USAGE)
+            return 1
+        try:
+            d_from = dt.date.fromisoformat(argv[2])
+            d_to = dt.date.fromisoformat(argv[3]) if cmd == "range" else dt.date.today()
+        except ValueError:
+            print(USAGE)
+            return 1
+        if d_from > d_to:
+            print(USAGE)
+            return 1
+        return cmd_range(d_from, d_to)
     print("Unknown command")
+    print(USAGE)
     return 1
 
 if __name__ == "__main__":